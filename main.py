@@ -1,11 +1,18 @@
 import os
 import re
-import json
-from datetime import date, datetime
+import asyncio
+import time
+import secrets
+from functools import lru_cache
+from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
-from fastapi import FastAPI, Request
+import aiosqlite
+from aiolimiter import AsyncLimiter
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 
 from telegram import Update, ReplyKeyboardRemove
@@ -19,9 +26,9 @@ from telegram.ext import (
     filters,
 )
 
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from aiogoogle import Aiogoogle
+from aiogoogle.auth.creds import ServiceAccountCreds
+from aiogoogle.excs import HTTPError
 
 
 # ---------------------------
@@ -38,10 +45,16 @@ PUBLIC_URL = (os.getenv("PUBLIC_URL") or "").strip().rstrip("/")
 WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip()
 
 REG_DEADLINE = (os.getenv("REG_DEADLINE") or "2025-12-25").strip()
+_DEADLINE_DATE = date(*map(int, REG_DEADLINE.split("-")))  # parsed once; bad value fails at startup
 
 GSHEET_ID = (os.getenv("GSHEET_ID") or "").strip()
 GSHEET_TAB = (os.getenv("GSHEET_TAB") or "Sheet1").strip()
 GOOGLE_SERVICE_ACCOUNT_JSON = (os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON") or "").strip()
+SHEETS_SYNC_INTERVAL = int(os.getenv("SHEETS_SYNC_INTERVAL", "30") or "30")  # seconds between mirror runs
+
+DB_PATH = (os.getenv("DB_PATH") or "registrations.db").strip()
+CHAT_QUEUE_IDLE_TTL = 300  # seconds; an idle per-chat update worker exits after this
+NOTIFY_RATE = 25  # messages/second for /notify broadcasts (Telegram allows ~30 bot-wide)
 
 # Normalize PUBLIC_URL (many people paste without https://)
 if PUBLIC_URL and not PUBLIC_URL.startswith(("http://", "https://")):
@@ -56,6 +69,9 @@ if not PUBLIC_URL:
     raise RuntimeError("Missing PUBLIC_URL")
 if not WEBHOOK_SECRET:
     raise RuntimeError("Missing WEBHOOK_SECRET")
+if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    # also sent as Telegram's secret_token, which only allows these characters
+    raise RuntimeError("WEBHOOK_SECRET may only contain A-Z, a-z, 0-9, _ and -")
 if not GSHEET_ID:
     raise RuntimeError("Missing GSHEET_ID")
 if not GOOGLE_SERVICE_ACCOUNT_JSON:
@@ -64,6 +80,10 @@ if not GOOGLE_SERVICE_ACCOUNT_JSON:
 WEBHOOK_PATH = f"/telegram/webhook/{WEBHOOK_SECRET}"
 WEBHOOK_URL = f"{PUBLIC_URL}{WEBHOOK_PATH}"
 
+# Shared reply kwargs, built once
+_MD = {"parse_mode": ParseMode.MARKDOWN}
+_RKB_REMOVE = ReplyKeyboardRemove()
+
 # ---------------------------
 # Conversation states
 # ---------------------------
@@ -108,11 +128,43 @@ GROUP_RULE = (
     "- P dan CH gacha bo‘lgan familiyalar — 28-dekabr"
 )
 
+# Static parts are joined once; only user fields are filled per message via .format()
+CHECK_TEMPLATE = (
+    "✅ *Tekshiring:*\n\n"
+    "👧🧒 Farzand: *{child_fullname}*\n"
+    "👤 Ota-ona: *{parent_fullname}*\n"
+    "📞 Telefon: *{parent_phone}*\n\n"
+    "Tasdiqlash uchun: *Ha* (yozing)\nBekor qilish: *Yo‘q*"
+)
+
+ADMIN_CAPTION_TEMPLATE = (
+    "🆕 *Yangi ro‘yxatdan o‘tish*\n\n"
+    "👧🧒 Farzand: *{child_fullname}*\n"
+    "👤 Ota-ona: *{parent_fullname}*\n"
+    "📞 Telefon: *{parent_phone}*\n\n"
+    + GROUP_RULE + "\n\n"
+    "👤 Username: @{username}\n"
+    "🆔 user_id: `{user_id}`\n"
+    "💬 chat_id: `{chat_id}`\n"
+    "🕒 Vaqt: {ts}"
+)
+
+SEED_PENDING = "⚠️ Sheets'dagi avvalgi ro‘yxat hali bazaga yuklanmagan."
+
+THANKS = (
+    "✨ *Ro‘yxatdan o‘tganingiz uchun rahmat!*\n\n"
+    + GROUP_RULE + "\n\n"
+    "📩 Ro‘yxat yopilgach, kelish sanangiz bo‘yicha xabarnoma yuboriladi."
+)
+
 # ---------------------------
 # ✅ Assign day by surname (Uzbek Latin)
 # ---------------------------
+_FIRST_CHAR_TO_DAY = {c: 27 for c in "ABCDEFGHIJKLMNO"} | {c: 28 for c in "PQRSTUVWXYZ"}
+_STRIP_MARKS = str.maketrans("", "", "’'-`")  # apostrophes, hyphens
+
 def _extract_surname(fullname: str) -> str:
-    parts = [p for p in (fullname or "").strip().split() if p]
+    parts = (fullname or "").rsplit(maxsplit=1)
     return parts[-1] if parts else ""
 
 def assign_day_by_surname(fullname_for_grouping: str) -> int:
@@ -122,11 +174,7 @@ def assign_day_by_surname(fullname_for_grouping: str) -> int:
     - P..CH -> 28-dekabr
     Eslatma: CH doim 28.
     """
-    surname = _extract_surname(fullname_for_grouping)
-    s = (surname or "").strip().upper()
-
-    # normalize apostrophes, hyphens
-    s = s.replace("’", "").replace("'", "").replace("-", "").replace("`", "")
+    s = _extract_surname(fullname_for_grouping).translate(_STRIP_MARKS).upper()
 
     if not s:
         return 27
@@ -134,26 +182,33 @@ def assign_day_by_surname(fullname_for_grouping: str) -> int:
     if s.startswith("CH"):
         return 28
 
-    first = s[0]
-    if "A" <= first <= "O":
-        return 27
-    if "P" <= first <= "Z":
-        return 28
-    return 27
+    return _FIRST_CHAR_TO_DAY.get(s[0], 27)
 
 
 # ---------------------------
 # Google Sheets helpers
 # ---------------------------
-SHEETS = None  # init later
+SHEETS = None  # discovered sheets v4 API, init later
 
-def _sheets_service():
-    info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-    creds = Credentials.from_service_account_info(
-        info,
+@lru_cache(maxsize=1)
+def _sheets_client() -> Aiogoogle:
+    creds = ServiceAccountCreds(
         scopes=["https://www.googleapis.com/auth/spreadsheets"],
+        **orjson.loads(GOOGLE_SERVICE_ACCOUNT_JSON),
     )
-    return build("sheets", "v4", credentials=creds, cache_discovery=False)
+    return Aiogoogle(service_account_creds=creds)
+
+async def _sheet_values():
+    global SHEETS
+    if SHEETS is None:
+        async with _sheets_client() as aiogoogle:
+            SHEETS = await aiogoogle.discover("sheets", "v4")
+    return SHEETS.spreadsheets.values
+
+async def _sheets_execute(request):
+    # the client keeps the access token; each call only opens its own HTTP session
+    async with _sheets_client() as aiogoogle:
+        return await aiogoogle.as_service_account(request)
 
 def tab_range(a1: str) -> str:
     return f"{GSHEET_TAB}!{a1}"
@@ -161,23 +216,24 @@ def tab_range(a1: str) -> str:
 def now_str() -> str:
     return datetime.now(TZ).strftime("%Y-%m-%d %H:%M:%S")
 
+# Registration closes at 00:00 Tashkent time on the day after REG_DEADLINE
+_REG_CLOSES_AT = datetime.combine(
+    _DEADLINE_DATE + timedelta(days=1), datetime.min.time(), tzinfo=TZ
+).timestamp()
+
 def deadline_passed() -> bool:
-    y, m, d = [int(x) for x in REG_DEADLINE.split("-")]
-    dl = date(y, m, d)
-    return datetime.now(TZ).date() > dl
+    # same as datetime.now(TZ).date() > _DEADLINE_DATE, without a tz conversion per call
+    return time.time() >= _REG_CLOSES_AT
 
-def ensure_headers():
+async def ensure_headers():
     """
     Creates header row if missing.
     IMPORTANT: Called in try/except on startup so it never kills the app.
     """
-    global SHEETS
-    if SHEETS is None:
-        SHEETS = _sheets_service()
-
-    resp = SHEETS.spreadsheets().values().get(
-        spreadsheetId=GSHEET_ID, range=tab_range("A1:J1")
-    ).execute()
+    values = await _sheet_values()
+    resp = await _sheets_execute(
+        values.get(spreadsheetId=GSHEET_ID, range=tab_range("A1:J1"))
+    )
     vals = resp.get("values", [])
 
     if vals and len(vals[0]) >= 3:
@@ -188,24 +244,80 @@ def ensure_headers():
         "child_fullname", "parent_fullname", "parent_phone",
         "photo_file_id", "assigned_day", "notified_at"
     ]]
-    SHEETS.spreadsheets().values().update(
+    await _sheets_execute(values.update(
         spreadsheetId=GSHEET_ID,
         range=tab_range("A1:J1"),
         valueInputOption="RAW",
-        body={"values": headers},
-    ).execute()
+        json={"values": headers},
+    ))
 
-def get_all_rows() -> List[List[str]]:
-    global SHEETS
-    if SHEETS is None:
-        SHEETS = _sheets_service()
-
-    resp = SHEETS.spreadsheets().values().get(
-        spreadsheetId=GSHEET_ID, range=tab_range("A2:J")
-    ).execute()
+async def get_all_rows() -> List[List[str]]:
+    values = await _sheet_values()
+    resp = await _sheets_execute(
+        values.get(spreadsheetId=GSHEET_ID, range=tab_range("A2:J"))
+    )
     return resp.get("values", [])
 
-def upsert_registration_row(
+# ---------------------------
+# SQLite store (source of truth)
+# ---------------------------
+_db: Optional[aiosqlite.Connection] = None
+_seeded = False  # rows already in Sheets imported (persisted in meta.seeded_at)
+
+# rev is bumped on every change; the Sheets mirror copies rows where synced_rev < rev.
+# full_rev is the rev of the last change outside notified_at: rows with
+# full_rev <= synced_rev only need column J rewritten.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registrations (
+    chat_id         INTEGER PRIMARY KEY,
+    user_id         INTEGER,
+    username        TEXT NOT NULL DEFAULT '',
+    child_fullname  TEXT NOT NULL,
+    parent_fullname TEXT NOT NULL,
+    parent_phone    TEXT NOT NULL,
+    photo_file_id   TEXT NOT NULL,
+    assigned_day    INTEGER NOT NULL,
+    created_at      TEXT NOT NULL,
+    notified_at     TEXT NOT NULL DEFAULT '',
+    rev             INTEGER NOT NULL DEFAULT 1,
+    full_rev        INTEGER NOT NULL DEFAULT 1,
+    synced_rev      INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_registrations_day_notified
+    ON registrations (assigned_day, notified_at);
+CREATE INDEX IF NOT EXISTS idx_registrations_unsynced
+    ON registrations (synced_rev, rev);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Sheet column order (A..J)
+SHEET_COLUMNS = (
+    "created_at", "chat_id", "user_id", "username",
+    "child_fullname", "parent_fullname", "parent_phone",
+    "photo_file_id", "assigned_day", "notified_at",
+)
+
+async def init_db():
+    global _db, _seeded
+    _db = await aiosqlite.connect(DB_PATH)
+    await _db.executescript(SCHEMA)
+    async with _db.execute("PRAGMA table_info(registrations)") as cur:
+        columns = {r[1] for r in await cur.fetchall()}
+    if "full_rev" not in columns:  # DB created before full_rev existed
+        await _db.execute("ALTER TABLE registrations ADD COLUMN full_rev INTEGER NOT NULL DEFAULT 1")
+        await _db.execute("UPDATE registrations SET full_rev = rev")
+    await _db.commit()
+    async with _db.execute("SELECT 1 FROM meta WHERE key = 'seeded_at'") as cur:
+        _seeded = await cur.fetchone() is not None
+
+async def close_db():
+    if _db is not None:
+        await _db.close()
+
+async def upsert_registration(
     chat_id: int,
     user_id: int,
     username: str,
@@ -214,99 +326,222 @@ def upsert_registration_row(
     parent_phone: str,
     photo_file_id: str,
     assigned_day: int,
+    created_at: Optional[str] = None,
 ):
     """
-    If chat_id exists, update that row; else append new row.
+    One row per chat_id; re-registering overwrites it and clears notified_at.
     """
-    global SHEETS
-    if SHEETS is None:
-        SHEETS = _sheets_service()
-
-    rows = get_all_rows()
-    target_row_index = None  # 0-based in rows (A2=0)
-    for idx, r in enumerate(rows):
-        if len(r) >= 2 and str(r[1]).strip() == str(chat_id):
-            target_row_index = idx
-            break
-
-    values = [[
-        now_str(), str(chat_id), str(user_id), username or "",
-        child_fullname, parent_fullname, parent_phone,
-        photo_file_id, str(assigned_day), ""  # notified_at empty
-    ]]
+    await _db.execute(
+        """
+        INSERT INTO registrations (
+            chat_id, user_id, username, child_fullname, parent_fullname,
+            parent_phone, photo_file_id, assigned_day, created_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            user_id = excluded.user_id,
+            username = excluded.username,
+            child_fullname = excluded.child_fullname,
+            parent_fullname = excluded.parent_fullname,
+            parent_phone = excluded.parent_phone,
+            photo_file_id = excluded.photo_file_id,
+            assigned_day = excluded.assigned_day,
+            created_at = excluded.created_at,
+            notified_at = '',
+            rev = rev + 1,
+            full_rev = rev + 1
+        """,
+        (
+            chat_id, user_id, username or "", child_fullname, parent_fullname,
+            parent_phone, photo_file_id, assigned_day, created_at or now_str(),
+        ),
+    )
+    await _db.commit()
+
+async def get_chat_ids_to_notify(day: int) -> List[int]:
+    async with _db.execute(
+        "SELECT chat_id FROM registrations WHERE assigned_day = ? AND notified_at = '' ORDER BY created_at",
+        (day,),
+    ) as cur:
+        return [r[0] for r in await cur.fetchall()]
+
+async def counts_by_day() -> Dict[int, int]:
+    out = {27: 0, 28: 0}
+    async with _db.execute(
+        "SELECT assigned_day, COUNT(*) FROM registrations GROUP BY assigned_day"
+    ) as cur:
+        for day, n in await cur.fetchall():
+            out[day] = n
+    return out
+
+async def mark_notified_many(chat_ids: List[int]):
+    """
+    Sets notified_at for all given chats; the whole batch shares one timestamp.
+    """
+    if not chat_ids:
+        return
+    ts = now_str()
+    await _db.executemany(
+        "UPDATE registrations SET notified_at = ?, rev = rev + 1 WHERE chat_id = ?",
+        [(ts, cid) for cid in chat_ids],
+    )
+    await _db.commit()
 
-    if target_row_index is None:
-        SHEETS.spreadsheets().values().append(
-            spreadsheetId=GSHEET_ID,
-            range=tab_range("A2:J"),
-            valueInputOption="RAW",
-            insertDataOption="INSERT_ROWS",
-            body={"values": values},
-        ).execute()
-    else:
-        row_num = 2 + target_row_index
-        SHEETS.spreadsheets().values().update(
-            spreadsheetId=GSHEET_ID,
-            range=tab_range(f"A{row_num}:J{row_num}"),
-            valueInputOption="RAW",
-            body={"values": values},
-        ).execute()
 
-def get_chat_ids_to_notify(day: int) -> List[int]:
+# ---------------------------
+# Sheets mirror (out of band)
+# ---------------------------
+def _row_day(r: List[str]) -> Optional[int]:
     """
-    ✅ IMPORTANT FIX:
-    Google Sheets often returns rows WITHOUT the last empty columns.
-    If notified_at (J) is empty, the row might have only 9 columns.
+    Day from parent_fullname (same A–O / P–CH rule users were shown), no dependency
+    on stored assigned_day: older rows may hold a day from an earlier rule.
+    """
+    if len(r) < 6:  # need parent_fullname
+        return None
+    day = assign_day_by_surname(str(r[5]).strip())
+    stored = str(r[8]).strip() if len(r) >= 9 else ""
+    if stored and stored != str(day):
+        print(f"Sheet row chat_id={r[1] if len(r) > 1 else '?'}: assigned_day {stored} -> {day} (surname rule)")
+    return day
+
+async def _sheet_row_index() -> Dict[str, int]:
+    """
+    chat_id -> 0-based row index (A2=0), read fresh from column B before every
+    write, so rows sorted/inserted/deleted by hand in the sheet are never overwritten.
+    """
+    values = await _sheet_values()
+    resp = await _sheets_execute(
+        values.get(spreadsheetId=GSHEET_ID, range=tab_range("B2:B"))
+    )
+    index: Dict[str, int] = {}
+    for idx, r in enumerate(resp.get("values", [])):
+        if r:
+            # first row wins, same as the old linear scan
+            index.setdefault(str(r[0]).strip(), idx)
+    return index
+
+async def seed_db_from_sheet():
     """
-    rows = get_all_rows()
-    out: List[int] = []
+    Imports the rows already in Sheets (first run, or a fresh disk), marked as
+    synced so the mirror doesn't write them back. assigned_day comes from the
+    surname rule; rows whose stored I disagrees stay unsynced so the mirror
+    rewrites I. Retried by the sync loop until it succeeds once; chats already
+    in the DB keep their DB row.
+    """
+    global _seeded
+    if _seeded:
+        return
 
-    for r in rows:
-        if len(r) < 6:  # need chat_id and parent_fullname
+    params = []
+    for r in await get_all_rows():
+        day = _row_day(r)
+        try:
+            chat_id = int(str(r[1]).strip())
+        except Exception:
             continue
+        if day is None:
+            continue
+        r = [str(v) for v in r] + [""] * (10 - len(r))
+        synced_rev = 1 if r[8].strip() == str(day) else 0
+        params.append((chat_id, r[2], r[3], r[4], r[5], r[6], r[7], day, r[0], r[9], synced_rev))
+
+    await _db.executemany(
+        """
+        INSERT OR IGNORE INTO registrations (
+            chat_id, user_id, username, child_fullname, parent_fullname,
+            parent_phone, photo_file_id, assigned_day, created_at, notified_at,
+            rev, full_rev, synced_rev
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, 1, ?)
+        """,
+        params,
+    )
+    await _db.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('seeded_at', ?)", (now_str(),)
+    )
+    await _db.commit()
+    _seeded = True
 
-        chat_id_str = str(r[1]).strip()
-        parent_fullname = str(r[5]).strip()
+async def sync_sheets():
+    """
+    Copies changed rows to Sheets: one values.batchUpdate for rows already
+    there, one values.append for new ones. A row whose only change is
+    notified_at gets just column J, so hand edits of A–I survive /notify;
+    a re-registration still rewrites the whole A:J row.
+    """
+    async with _db.execute(
+        f"SELECT {', '.join(SHEET_COLUMNS)}, full_rev, synced_rev, rev FROM registrations"
+        " WHERE synced_rev < rev ORDER BY created_at"
+    ) as cur:
+        changed = await cur.fetchall()
+    if not changed:
+        return
 
-        # if J is missing => treat as not notified
-        notified = str(r[9]).strip() if len(r) >= 10 else ""
-        if notified != "":
-            continue
+    row_index = await _sheet_row_index()
+    data, appends = [], []
+    for *cols, full_rev, synced_rev, _rev in changed:
+        row = ["" if v is None else str(v) for v in cols]
+        idx = row_index.get(row[1])
+        if idx is None:
+            appends.append(row)
+        elif full_rev <= synced_rev:
+            row_num = 2 + idx
+            data.append({"range": tab_range(f"J{row_num}"), "values": [[row[9]]]})
+        else:
+            row_num = 2 + idx
+            data.append({"range": tab_range(f"A{row_num}:J{row_num}"), "values": [row]})
 
-        computed_day = assign_day_by_surname(parent_fullname)
-        if computed_day != day:
-            continue
+    values = await _sheet_values()
+    if data:
+        await _sheets_execute(values.batchUpdate(
+            spreadsheetId=GSHEET_ID,
+            json={"valueInputOption": "RAW", "data": data},
+        ))
+    if appends:
+        await _sheets_execute(values.append(
+            spreadsheetId=GSHEET_ID,
+            range=tab_range("A2:J"),
+            valueInputOption="RAW",
+            insertDataOption="INSERT_ROWS",
+            json={"values": appends},
+        ))
 
+    # rows changed again while we were writing keep synced_rev < rev and go next tick
+    await _db.executemany(
+        "UPDATE registrations SET synced_rev = ? WHERE chat_id = ?",
+        [(rev, int(cols[1])) for *cols, rev in changed],
+    )
+    await _db.commit()
+
+async def sheets_sync_loop():
+    while True:
+        await asyncio.sleep(SHEETS_SYNC_INTERVAL)
+        if not _seeded:
+            try:
+                await seed_db_from_sheet()
+            except Exception as e:
+                print("Sheets seed failed:", e)
         try:
-            out.append(int(chat_id_str))
-        except Exception:
-            continue
+            await sync_sheets()
+        except Exception as e:
+            print("Sheets sync failed:", e)
 
-    return out
 
-def mark_notified(chat_id: int):
-    global SHEETS
-    if SHEETS is None:
-        SHEETS = _sheets_service()
+# ---------------------------
+# Validators (verdicts cached for repeated input)
+# ---------------------------
+@lru_cache(maxsize=1024)
+def _validate_fullname(text: str) -> bool:
+    return len(text.split()) >= 2
 
-    rows = get_all_rows()
-    for idx, r in enumerate(rows):
-        if len(r) >= 2 and str(r[1]).strip() == str(chat_id):
-            row_num = 2 + idx
-            SHEETS.spreadsheets().values().update(
-                spreadsheetId=GSHEET_ID,
-                range=tab_range(f"J{row_num}"),
-                valueInputOption="RAW",
-                body={"values": [[now_str()]]},
-            ).execute()
-            return
+@lru_cache(maxsize=1024)
+def _validate_phone(phone: str) -> bool:
+    return PHONE_RE.match(phone) is not None
 
 
 # ---------------------------
 # Telegram handlers
 # ---------------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(WELCOME, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(WELCOME, **_MD)
 
 async def whoami(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
@@ -315,87 +550,85 @@ async def whoami(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"👤 username: @{u.username if u.username else '—'}\n"
         f"🆔 user_id: {u.id}\n"
         f"💬 chat_id: {c.id}",
-        parse_mode=ParseMode.MARKDOWN,
+        **_MD,
     )
 
 async def register_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if deadline_passed():
-        await update.message.reply_text(CLOSED, parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text(CLOSED, **_MD)
         return ConversationHandler.END
 
     context.user_data.clear()
     await update.message.reply_text(
         "1) Farzandning *ism va familiyasi*ni yuboring (to‘liq).",
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=ReplyKeyboardRemove(),
+        **_MD,
+        reply_markup=_RKB_REMOVE,
     )
     return CHILD_FULLNAME
 
 async def child_fullname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
-    if len(text.split()) < 2:
-        await update.message.reply_text("Iltimos, *to‘liq F.I.Sh* yuboring.", parse_mode=ParseMode.MARKDOWN)
+    if not _validate_fullname(text):
+        await update.message.reply_text("Iltimos, *to‘liq F.I.Sh* yuboring.", **_MD)
         return CHILD_FULLNAME
     context.user_data["child_fullname"] = text
-    await update.message.reply_text("2) Kuzatuvchi ota-onaning *ism va familiyasi*ni yuboring.", parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text("2) Kuzatuvchi ota-onaning *ism va familiyasi*ni yuboring.", **_MD)
     return PARENT_FULLNAME
 
 async def parent_fullname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
-    if len(text.split()) < 2:
-        await update.message.reply_text("Iltimos, *to‘liq F.I.Sh* yuboring.", parse_mode=ParseMode.MARKDOWN)
+    if not _validate_fullname(text):
+        await update.message.reply_text("Iltimos, *to‘liq F.I.Sh* yuboring.", **_MD)
         return PARENT_FULLNAME
     context.user_data["parent_fullname"] = text
-    await update.message.reply_text("3) Farzandning *fotosurati*ni yuboring (foto/selfi).", parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text("3) Farzandning *fotosurati*ni yuboring (foto/selfi).", **_MD)
     return CHILD_PHOTO
 
 async def child_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.photo:
-        await update.message.reply_text("Iltimos, rasmni *foto* ko‘rinishida yuboring.", parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text("Iltimos, rasmni *foto* ko‘rinishida yuboring.", **_MD)
         return CHILD_PHOTO
-    context.user_data["photo_file_id"] = update.message.photo[-1].file_id
-    await update.message.reply_text("4) Telefon raqamingizni yuboring. Masalan: +99890xxxxxxx", parse_mode=ParseMode.MARKDOWN)
+    context.user_data["photo_file_id"] = update.message.photo[-1].file_id  # only the id; bytes stay on Telegram
+    await update.message.reply_text("4) Telefon raqamingizni yuboring. Masalan: +99890xxxxxxx", **_MD)
     return PARENT_PHONE
 
 async def parent_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if deadline_passed():
-        await update.message.reply_text(CLOSED, parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text(CLOSED, **_MD)
         return ConversationHandler.END
 
     phone = (update.message.text or "").strip()
-    if not PHONE_RE.match(phone):
-        await update.message.reply_text("Telefon raqam noto‘g‘ri. Masalan: +99890xxxxxxx", parse_mode=ParseMode.MARKDOWN)
+    if not _validate_phone(phone):
+        await update.message.reply_text("Telefon raqam noto‘g‘ri. Masalan: +99890xxxxxxx", **_MD)
         return PARENT_PHONE
 
     context.user_data["parent_phone"] = phone
     await update.message.reply_text(
-        "✅ *Tekshiring:*\n\n"
-        f"👧🧒 Farzand: *{context.user_data['child_fullname']}*\n"
-        f"👤 Ota-ona: *{context.user_data['parent_fullname']}*\n"
-        f"📞 Telefon: *{context.user_data['parent_phone']}*\n\n"
-        "Tasdiqlash uchun: *Ha* (yozing)\nBekor qilish: *Yo‘q*",
-        parse_mode=ParseMode.MARKDOWN,
+        CHECK_TEMPLATE.format_map(context.user_data),
+        **_MD,
     )
     return CONFIRM
 
 async def send_to_admin(context: ContextTypes.DEFAULT_TYPE, user, payload: Dict[str, Any]):
     # ✅ removed “Taqsimlangan kun” from admin text too (you said you don’t need it)
-    caption = (
-        "🆕 *Yangi ro‘yxatdan o‘tish*\n\n"
-        f"👧🧒 Farzand: *{payload['child_fullname']}*\n"
-        f"👤 Ota-ona: *{payload['parent_fullname']}*\n"
-        f"📞 Telefon: *{payload['parent_phone']}*\n\n"
-        f"{GROUP_RULE}\n\n"
-        f"👤 Username: @{user.username if user.username else '—'}\n"
-        f"🆔 user_id: `{user.id}`\n"
-        f"💬 chat_id: `{payload['chat_id']}`\n"
-        f"🕒 Vaqt: {now_str()}"
+    caption = ADMIN_CAPTION_TEMPLATE.format(
+        child_fullname=payload["child_fullname"],
+        parent_fullname=payload["parent_fullname"],
+        parent_phone=payload["parent_phone"],
+        username=user.username if user.username else "—",
+        user_id=user.id,
+        chat_id=payload["chat_id"],
+        ts=payload["ts"],
     )
+    # Photos are forwarded by Telegram file_id only (Telegram is the CDN):
+    # never download/re-upload registration photos here or in any future
+    # forward (e.g. an admin gallery should sendMediaGroup with file_ids).
+    assert isinstance(payload["photo_file_id"], str), "photo must be a Telegram file_id"
     await context.bot.send_photo(
         chat_id=ADMIN_CHAT_ID,
         photo=payload["photo_file_id"],
         caption=caption,
-        parse_mode=ParseMode.MARKDOWN,
+        **_MD,
     )
 
 async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -404,7 +637,7 @@ async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Bekor qilindi. /register orqali qayta boshlang.")
         return ConversationHandler.END
     if ans not in {"ha", "xa", "yes", "ok"}:
-        await update.message.reply_text("Iltimos, *Ha* yoki *Yo‘q* deb javob bering.", parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text("Iltimos, *Ha* yoki *Yo‘q* deb javob bering.", **_MD)
         return CONFIRM
 
     user = update.effective_user
@@ -413,22 +646,6 @@ async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ✅ group day is determined by parent surname
     assigned_day = assign_day_by_surname(context.user_data.get("parent_fullname", ""))
 
-    # Write to Sheets (try, but don't crash)
-    try:
-        upsert_registration_row(
-            chat_id=chat_id,
-            user_id=user.id,
-            username=user.username or "",
-            child_fullname=context.user_data["child_fullname"],
-            parent_fullname=context.user_data["parent_fullname"],
-            parent_phone=context.user_data["parent_phone"],
-            photo_file_id=context.user_data["photo_file_id"],
-            assigned_day=assigned_day,  # kept for audit, but not shown in messages
-        )
-    except Exception as e:
-        print("Sheets upsert failed:", e)
-
-    # Always send to admin (with photo)
     payload = {
         "chat_id": chat_id,
         "child_fullname": context.user_data["child_fullname"],
@@ -436,15 +653,32 @@ async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "parent_phone": context.user_data["parent_phone"],
         "photo_file_id": context.user_data["photo_file_id"],
         "assigned_day": assigned_day,
+        "ts": now_str(),  # one timestamp for the stored row and the admin caption
     }
-    await send_to_admin(context, user, payload)
 
-    await update.message.reply_text(
-        "✨ *Ro‘yxatdan o‘tganingiz uchun rahmat!*\n\n"
-        f"{GROUP_RULE}\n\n"
-        "📩 Ro‘yxat yopilgach, kelish sanangiz bo‘yicha xabarnoma yuboriladi.",
-        parse_mode=ParseMode.MARKDOWN,
+    # DB write and admin photo run together; Sheets gets the row on the next mirror run
+    db_res, admin_res = await asyncio.gather(
+        upsert_registration(
+            chat_id=chat_id,
+            user_id=user.id,
+            username=user.username or "",
+            child_fullname=payload["child_fullname"],
+            parent_fullname=payload["parent_fullname"],
+            parent_phone=payload["parent_phone"],
+            photo_file_id=payload["photo_file_id"],
+            assigned_day=assigned_day,  # drives /notify27, /notify28 and /export counts; not shown to the user
+            created_at=payload["ts"],
+        ),
+        send_to_admin(context, user, payload),  # always send to admin (with photo)
+        return_exceptions=True,
     )
+    # DB: try, but don't crash (admin still gets the photo + data)
+    if isinstance(db_res, Exception):
+        print("DB upsert failed:", db_res)
+    if isinstance(admin_res, BaseException):
+        raise admin_res
+
+    await update.message.reply_text(THANKS, **_MD)
     return ConversationHandler.END
 
 
@@ -455,15 +689,35 @@ def is_admin_chat(update: Update) -> bool:
     # ✅ ADMIN_CHAT_ID is a CHAT id. Check against chat.id, not user.id.
     return update.effective_chat and update.effective_chat.id == ADMIN_CHAT_ID
 
+# bucket of 1 refilled every 1/NOTIFY_RATE s: AsyncLimiter(NOTIFY_RATE, 1) would
+# let a full bucket (NOTIFY_RATE) burst on top of the steady rate
+_SEND_LIMIT = AsyncLimiter(1, 1 / NOTIFY_RATE)
+
+async def _send_notification(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, notified: List[int]
+) -> bool:
+    async with _SEND_LIMIT:
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=text, **_MD)
+        except Exception:
+            return False
+    notified.append(chat_id)  # recorded as it lands, so a cancelled run still knows who got it
+    return True
+
 async def notify_day(update: Update, context: ContextTypes.DEFAULT_TYPE, day: int):
     if not is_admin_chat(update):
         await update.message.reply_text("Bu buyruq faqat admin uchun.")
         return
 
+    if not _seeded:
+        # would silently skip everyone registered before this deploy
+        await update.message.reply_text(SEED_PENDING + "\nYuborish to‘xtatildi, birozdan so‘ng qayta urinib ko‘ring.")
+        return
+
     try:
-        chat_ids = get_chat_ids_to_notify(day)
+        chat_ids = await get_chat_ids_to_notify(day)
     except Exception as e:
-        await update.message.reply_text(f"Sheets xatolik: {e}")
+        await update.message.reply_text(f"DB xatolik: {e}")
         return
 
     if not chat_ids:
@@ -471,19 +725,26 @@ async def notify_day(update: Update, context: ContextTypes.DEFAULT_TYPE, day: in
         return
 
     msg = NOTIF_27 if day == 27 else NOTIF_28
-    sent, failed = 0, 0
-    for cid in chat_ids:
+    notified: List[int] = []
+    mark_error: Optional[Exception] = None
+    try:
+        # sends run concurrently; the limiter keeps them under Telegram's rate limit
+        await asyncio.gather(*[_send_notification(context, cid, msg, notified) for cid in chat_ids])
+    finally:
+        # one batched write for the whole run; also runs (shielded) if the worker is
+        # cancelled at shutdown, so chats already reached aren't re-sent by the next /notify
         try:
-            await context.bot.send_message(chat_id=cid, text=msg, parse_mode=ParseMode.MARKDOWN)
-            try:
-                mark_notified(cid)
-            except Exception:
-                pass
-            sent += 1
-        except Exception:
-            failed += 1
+            await asyncio.shield(mark_notified_many(notified))
+        except Exception as e:
+            print("DB mark_notified failed:", e)
+            mark_error = e
+
+    sent, failed = len(notified), len(chat_ids) - len(notified)
+    report = f"✅ Yuborildi: {sent}\n⚠️ Xatolik: {failed}"
+    if mark_error is not None:
+        report += f"\n⚠️ DB (notified_at yozilmadi): {mark_error}"
 
-    await update.message.reply_text(f"✅ Yuborildi: {sent}\n⚠️ Xatolik: {failed}")
+    await update.message.reply_text(report)
 
 async def notify27(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await notify_day(update, context, 27)
@@ -496,30 +757,26 @@ async def export_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Bu buyruq faqat admin uchun.")
         return
 
-    # counts are computed from surname logic on-the-fly (no dependency on stored assigned_day)
+    # counts come from the stored assigned_day (set by surname logic at registration)
     try:
-        rows = get_all_rows()
-        c27 = 0
-        c28 = 0
-        for r in rows:
-            if len(r) < 6:
-                continue
-            parent_fullname = str(r[5]).strip()
-            d = assign_day_by_surname(parent_fullname)
-            if d == 27:
-                c27 += 1
-            else:
-                c28 += 1
-        await update.message.reply_text(f"📊 Guruhlar:\n27-dekabr (A–O): {c27}\n28-dekabr (P–CH): {c28}")
+        counts = await counts_by_day()
+        c27, c28 = counts[27], counts[28]
+        text = f"📊 Guruhlar:\n27-dekabr (A–O): {c27}\n28-dekabr (P–CH): {c28}"
+        if not _seeded:
+            text += "\n\n" + SEED_PENDING + "\nSonlar to‘liq emas."
+        await update.message.reply_text(text)
     except Exception as e:
-        await update.message.reply_text(f"Sheets xatolik: {e}")
+        await update.message.reply_text(f"DB xatolik: {e}")
 
 
 # ---------------------------
 # FastAPI + PTB wiring
 # ---------------------------
-api = FastAPI(title="CBU NY Bot (Sheets + Push)")
-ptb_app = Application.builder().token(TOKEN).build()
+api = FastAPI(title="CBU NY Bot (SQLite + Sheets + Push)", default_response_class=ORJSONResponse)
+# Webhook mode: no polling Updater. Cross-chat concurrency comes from the
+# per-chat queues below (which call process_update directly), so
+# concurrent_updates stays off as ConversationHandler requires.
+ptb_app = Application.builder().token(TOKEN).updater(None).build()
 
 def setup_handlers():
     conv = ConversationHandler(
@@ -542,24 +799,81 @@ def setup_handlers():
     ptb_app.add_handler(CommandHandler("export", export_stats))
     ptb_app.add_handler(conv)
 
+_sync_task: Optional[asyncio.Task] = None
+
+# ---------------------------
+# Per-chat update queues: in-order within a chat, concurrent across chats
+# ---------------------------
+_chat_queues: Dict[int, asyncio.Queue] = {}
+_chat_workers: Dict[int, asyncio.Task] = {}
+
+async def _chat_worker(chat_id: int, q: asyncio.Queue):
+    while True:
+        try:
+            update = await asyncio.wait_for(q.get(), timeout=CHAT_QUEUE_IDLE_TTL)
+        except asyncio.TimeoutError:
+            if q.empty():  # no await between check and removal => nothing can slip in
+                _chat_queues.pop(chat_id, None)
+                _chat_workers.pop(chat_id, None)
+                return
+            continue
+        try:
+            await ptb_app.process_update(update)
+        except Exception as e:
+            print("Update processing failed:", e)
+        finally:
+            q.task_done()
+
+def enqueue_update(update: Update):
+    chat_id = update.effective_chat.id if update.effective_chat else 0  # 0: updates without a chat
+    q = _chat_queues.get(chat_id)
+    if q is None:
+        q = _chat_queues[chat_id] = asyncio.Queue()
+        _chat_workers[chat_id] = asyncio.create_task(_chat_worker(chat_id, q))
+    q.put_nowait(update)
+
+async def drain_chat_queues(timeout: float = 10):
+    joins = [asyncio.create_task(q.join()) for q in _chat_queues.values()]
+    if joins:
+        await asyncio.wait(joins, timeout=timeout)
+    for task in joins:
+        task.cancel()
+    workers = list(_chat_workers.values())
+    for task in workers:
+        task.cancel()
+    # wait for cancelled handlers' cleanup (e.g. notify_day's mark_notified_many) before the DB closes
+    await asyncio.gather(*workers, return_exceptions=True)
+
 @api.on_event("startup")
 async def on_startup():
+    global _sync_task
     setup_handlers()
+    await init_db()
 
     # PTB v21+ requires initialize()
     await ptb_app.initialize()
     await ptb_app.start()
 
-    # set webhook
-    await ptb_app.bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=True)
+    # set webhook: more parallel deliveries, only the update types we handle,
+    # and a secret header checked before the body is parsed
+    await ptb_app.bot.set_webhook(
+        url=WEBHOOK_URL,
+        max_connections=100,
+        allowed_updates=[Update.MESSAGE],
+        drop_pending_updates=True,
+        secret_token=WEBHOOK_SECRET,
+    )
 
     # Sheets setup should never block app start
     try:
-        ensure_headers()
-    except HttpError as e:
-        print("⚠️ Sheets HttpError:", e)
+        await ensure_headers()
+        await seed_db_from_sheet()
+    except HTTPError as e:
+        print("⚠️ Sheets HTTPError:", e)
     except Exception as e:
-        print("⚠️ Sheets ensure_headers failed:", e)
+        print("⚠️ Sheets ensure_headers/seed failed:", e)
+
+    _sync_task = asyncio.create_task(sheets_sync_loop())
 
 @api.on_event("shutdown")
 async def on_shutdown():
@@ -567,6 +881,16 @@ async def on_shutdown():
         await ptb_app.bot.delete_webhook(drop_pending_updates=False)
     except Exception:
         pass
+    await drain_chat_queues()
+    if _sync_task is not None:
+        _sync_task.cancel()
+        # let an in-flight append settle first, or the final sync would append the same rows again
+        await asyncio.gather(_sync_task, return_exceptions=True)
+    try:
+        await sync_sheets()
+    except Exception as e:
+        print("⚠️ Sheets final sync failed:", e)
+    await close_db()
     await ptb_app.stop()
     await ptb_app.shutdown()
 
@@ -576,7 +900,30 @@ async def root():
 
 @api.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
-    data = await request.json()
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    # compare bytes: compare_digest raises TypeError on non-ASCII str
+    if not secrets.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=403)
+
+    data = orjson.loads(await request.body())
     update = Update.de_json(data, ptb_app.bot)
-    await ptb_app.process_update(update)
+    # answer Telegram right away; the chat's worker runs the handlers
+    enqueue_update(update)
     return {"ok": True}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # One worker only: conversation state (PTB user_data), the per-chat queues
+    # and the Sheets mirror all live in this process, and Telegram may deliver
+    # any chat's update to any worker. Scale with uvloop/httptools instead.
+    uvicorn.run(
+        "main:api",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000") or "8000"),
+        workers=1,
+        loop="uvloop",
+        http="httptools",
+        lifespan="on",
+    )